@@ -2,9 +2,13 @@
 Streamlit app for viewing Overture Maps buildings using DuckDB-generated vector tiles.
 """
 import streamlit as st
+import streamlit.components.v1 as components
+import atexit
+import os
+import struct
+import subprocess
+import sys
 import time
-import threading
-from streamlit_autorefresh import st_autorefresh
 
 st.set_page_config(
     page_title="Streamlit Buildings Viewer",
@@ -14,12 +18,27 @@ st.set_page_config(
 
 TILE_SERVER_HOST = "127.0.0.1"
 TILE_SERVER_PORT = 8080
+TILE_SERVER_STARTUP_TIMEOUT = 10
+
+# Invisible component that receives bounds from the tile server's /bounds-stream
+_bounds_listener = components.declare_component(
+    "bounds_listener",
+    path=os.path.join(os.path.dirname(__file__), "bounds_listener")
+)
 
 
 def start_tile_server():
-    """Start the tile server in a background thread."""
-    from tile_server import run_server
-    run_server(host=TILE_SERVER_HOST, port=TILE_SERVER_PORT)
+    """Start the tile server as a separate process, stopped again when Streamlit exits."""
+    process = subprocess.Popen(
+        [
+            sys.executable, os.path.join(os.path.dirname(__file__), 'tile_server.py'),
+            '--host', TILE_SERVER_HOST,
+            '--port', str(TILE_SERVER_PORT)
+        ],
+        stdout=subprocess.DEVNULL
+    )
+    atexit.register(process.terminate)
+    return process
 
 
 def is_tile_server_running():
@@ -41,68 +60,32 @@ def ensure_tile_server_running():
     if is_tile_server_running():
         return True
 
-    if 'tile_server_started' not in st.session_state:
-        thread = threading.Thread(target=start_tile_server, daemon=True)
-        thread.start()
-        st.session_state.tile_server_started = True
-        time.sleep(2)
+    if 'tile_server_pid' not in st.session_state:
+        process = start_tile_server()
+        st.session_state.tile_server_pid = process.pid
+
+        # Give the server time to import and open its DuckDB connections
+        deadline = time.monotonic() + TILE_SERVER_STARTUP_TIMEOUT
+        while time.monotonic() < deadline and process.poll() is None:
+            if is_tile_server_running():
+                return True
+            time.sleep(0.25)
         return is_tile_server_running()
     return False
 
 
-def get_view_bounds():
-    """Fetch current view bounds from tile server."""
+def get_view_stats():
+    """Fetch current view bounds and building stats from tile server."""
     import requests
     try:
         response = requests.get(f"http://{TILE_SERVER_HOST}:{TILE_SERVER_PORT}/get-bounds", timeout=1)
         if response.ok:
-            return response.json().get('bounds')
+            return response.json()
     except:
         pass
     return None
 
 
-import duckdb
-import os
-
-@st.cache_resource
-def get_db_path():
-    """Get the database path."""
-    return os.path.join(os.path.dirname(__file__), "..", "nl_buildings.duckdb")
-
-
-def query_stats(bounds):
-    """Query DuckDB directly for building stats in bounds."""
-    if not bounds:
-        return {'count': 0, 'area': 0}
-
-    north = bounds.get('north')
-    south = bounds.get('south')
-    east = bounds.get('east')
-    west = bounds.get('west')
-
-    try:
-        with duckdb.connect(get_db_path(), read_only=True) as con:
-            con.execute("LOAD spatial;")
-            query = f"""
-                SELECT
-                    COUNT(*) as count,
-                    COALESCE(SUM(ST_Area(ST_Transform(geometry, 'EPSG:4326', 'EPSG:3857', TRUE))), 0) as area
-                FROM buildings
-                WHERE bbox.xmin <= {east}
-                  AND bbox.xmax >= {west}
-                  AND bbox.ymin <= {north}
-                  AND bbox.ymax >= {south}
-            """
-            result = con.execute(query).fetchone()
-            if result is None:
-                return {'count': 0, 'area': 0}
-            return {'count': result[0] or 0, 'area': result[1] or 0}
-    except Exception as e:
-        print(f"Error querying stats: {e}")
-        return {'count': 0, 'area': 0}
-
-
 def main():
     st.title("Streamlit Buildings Viewer")
 
@@ -136,31 +119,35 @@ def main():
     if 'stats' not in st.session_state:
         st.session_state.stats = {'count': 0, 'area': 0}
 
-    # Poll for bounds changes (lightweight check)
-    # DuckDB is only queried when bounds actually change
-    st_autorefresh(interval=1500, key="bounds_check")
-
-    # Get current bounds from tile server
-    bounds = get_view_bounds()
-
-    # Create a stable key by rounding coordinates to avoid floating-point precision issues
+    # The tile server pushes bounds and stats when the map moves, each push triggers
+    # a rerun. Until the first event arrives, fetch whatever it already has.
+    view = _bounds_listener(
+        stream_url=f"http://{TILE_SERVER_HOST}:{TILE_SERVER_PORT}/bounds-stream",
+        key="bounds_stream",
+        default=None
+    ) or get_view_stats() or {}
+    bounds = view.get('bounds')
+
+    # Create a stable key by rounding coordinates to avoid floating-point precision issues,
+    # packed into a compact bytestring so comparing keys is a single memcmp
     def make_bounds_key(b):
         if not b:
             return None
-        return (
-            round(b.get('north', 0), 4),
-            round(b.get('south', 0), 4),
-            round(b.get('east', 0), 4),
-            round(b.get('west', 0), 4),
-            round(b.get('zoom', 0), 1)
+        return struct.pack(
+            '<5i',
+            round(b.get('north', 0) * 1e4),
+            round(b.get('south', 0) * 1e4),
+            round(b.get('east', 0) * 1e4),
+            round(b.get('west', 0) * 1e4),
+            round((b.get('zoom') or 0) * 10)
         )
 
     bounds_key = make_bounds_key(bounds)
 
-    # Only query DuckDB when bounds have changed
+    # Stats are computed by the tile server, only refresh them when bounds have changed
     if bounds_key != st.session_state.last_bounds:
         st.session_state.last_bounds = bounds_key
-        st.session_state.stats = query_stats(bounds)
+        st.session_state.stats = {'count': view.get('count', 0), 'area': view.get('area', 0)}
 
     stats = st.session_state.stats
     st.markdown(f"**{stats['count']:,}** buildings | **{stats['area']:,.0f}** m² total area")
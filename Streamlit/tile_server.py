@@ -2,33 +2,126 @@
 Tile server for serving Overture Maps buildings as vector tiles using DuckDB ST_AsMVT.
 """
 import duckdb
-from flask import Flask, Response
-from flask_cors import CORS
+from quart import Quart, Response
+from quart_cors import cors
+from tile_spec import GZIP_LEVEL, NL_BBOX, PREBAKE_ZOOMS, lod_column, tile_properties
+import asyncio
+import contextlib
+import functools
+import gzip
+import itertools
 import math
 import os
+import queue
+import shutil
+import tempfile
 import threading
+import time
 
-app = Flask(__name__)
-CORS(app)
+app = Quart(__name__)
+app = cors(app, allow_origin='*')
 
 # Store current view stats (updated by map, read by Streamlit)
-current_stats = {'count': 0, 'area': 0, 'bounds': None}
+current_stats = {'count': 0, 'area': 0, 'bounds': None, 'version': 0, 'sequence': -1}
+
+# Numbers /update-view requests in arrival order, so slower stats queries can't overwrite newer bounds
+_update_sequence = itertools.count()
+
+# Signalled whenever current_stats['bounds'] changes
+_bounds_changed = asyncio.Condition()
+STREAM_HEARTBEAT_INTERVAL = 15
 
 # DuckDB database path
 _base_dir = os.path.dirname(__file__)
 DB_FILE = os.path.join(_base_dir, "..", "nl_buildings.duckdb")
 
-# Thread-local storage for DuckDB connections
-_thread_local = threading.local()
+# On-disk tile cache of gzipped MVTs, laid out as {z}/{x}/{y}.pbf.gz (empty tiles are 0-byte files)
+CACHE_DIR = os.path.join(_base_dir, "..", "tiles_cache")
+CACHE_MAX_BYTES = 2 * 1024 ** 3
+CACHE_EVICT_INTERVAL = 300
+
+MVT_MIMETYPE = 'application/vnd.mapbox-vector-tile'
+
+# Lowest zoom level tiles are rendered at
+MIN_ZOOM = 10
+
+# Number of hot tiles kept in memory in front of the disk cache
+TILE_MEMORY_CACHE_SIZE = 2048
+
+# Bumped by /invalidate; part of the memory cache key, and tiles rendered under an
+# older generation are not written to disk, so nothing from the old database survives
+_cache_generation = 0
+
+# Bounded pool of DuckDB connections, caps the number of concurrent DuckDB queries
+POOL_SIZE = 4
+
+# DuckDB settings. The pooled connections all open the same file and so share one
+# database instance: these are totals for the whole process, not per connection,
+# and the POOL_SIZE concurrent queries share the one thread pool
+DUCKDB_CONFIG = {
+    'threads': os.cpu_count() or 1,
+    'memory_limit': '4GB',
+    'enable_object_cache': True,
+    'temp_directory': os.path.join(tempfile.gettempdir(), 'duckdb')
+}
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def init_pool() -> queue.Queue:
+    """Create the connection pool, opening POOL_SIZE connections up front."""
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            pool = queue.Queue(maxsize=POOL_SIZE)
+            for _ in range(POOL_SIZE):
+                con = duckdb.connect(DB_FILE, read_only=True, config=DUCKDB_CONFIG)
+                con.execute("LOAD spatial;")
+                pool.put(con)
+            _pool = pool
+    return _pool
+
+
+def reset_pool():
+    """Close every pooled connection and open fresh ones, e.g. after the database file was replaced.
+
+    All old connections must be closed first: DuckDB hands out the already open
+    instance, still reading the deleted file, as long as any connection to it exists.
+    """
+    global _pool
+    with _pool_lock:
+        old_pool, _pool = _pool, None
+        if old_pool is not None:
+            # Waits for in-flight queries to hand their connection back
+            for _ in range(POOL_SIZE):
+                old_pool.get().close()
+    init_pool()
+
+
+@contextlib.contextmanager
+def get_connection():
+    """Borrow a DuckDB connection from the pool for the duration of the block."""
+    pool = _pool or init_pool()
+    con = pool.get()
+    try:
+        yield con
+    finally:
+        pool.put(con)
 
 
-def get_connection():
-    """Get or create a thread-local DuckDB connection."""
-    if not hasattr(_thread_local, 'connection'):
-        con = duckdb.connect(DB_FILE, read_only=True)
-        con.execute("LOAD spatial;")
-        _thread_local.connection = con
-    return _thread_local.connection
+def tile_edge_lat(z: int, y: int) -> float:
+    """Latitude of the northern edge of tile row y at zoom z."""
+    n = 2.0 ** z
+    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y / n)))
+    return math.degrees(lat_rad)
+
+
+# Tile edge latitudes for every row up to the map's maxzoom, indexed as [z][y]
+LAT_TABLE_MAX_ZOOM = 16
+TILE_EDGE_LATS = [
+    [tile_edge_lat(z, y) for y in range(2 ** z + 1)]
+    for z in range(LAT_TABLE_MAX_ZOOM + 1)
+]
 
 
 def tile_to_bbox(z: int, x: int, y: int) -> tuple[float, float, float, float]:
@@ -36,112 +129,318 @@ def tile_to_bbox(z: int, x: int, y: int) -> tuple[float, float, float, float]:
     n = 2.0 ** z
     min_lon = x / n * 360.0 - 180.0
     max_lon = (x + 1) / n * 360.0 - 180.0
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * y / n)))
-    max_lat = math.degrees(lat_rad)
-    lat_rad = math.atan(math.sinh(math.pi * (1 - 2 * (y + 1) / n)))
-    min_lat = math.degrees(lat_rad)
+    if z <= LAT_TABLE_MAX_ZOOM and y < n:
+        max_lat = TILE_EDGE_LATS[z][y]
+        min_lat = TILE_EDGE_LATS[z][y + 1]
+    else:
+        max_lat = tile_edge_lat(z, y)
+        min_lat = tile_edge_lat(z, y + 1)
     return (min_lon, min_lat, max_lon, max_lat)
 
 
+def tile_cache_path(z: int, x: int, y: int) -> str:
+    """Path of the cached tile file for the given z/x/y coordinates."""
+    return os.path.join(CACHE_DIR, f"{z}/{x}/{y}.pbf.gz")
+
+
+def write_cached_tile(path: str, tile_data: bytes):
+    """Atomically write tile bytes to the disk cache."""
+    directory = os.path.dirname(path)
+    os.makedirs(directory, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=directory, suffix='.tmp', delete=False) as tmp:
+        tmp.write(tile_data)
+    os.replace(tmp.name, path)
+
+
+def evict_tile_cache():
+    """Remove least recently accessed tiles until the cache fits CACHE_MAX_BYTES.
+
+    Pre-baked zoom levels are left alone: they are not counted towards the limit and
+    never deleted, since their atime stays at build time while the memory cache serves them.
+    """
+    files = []
+    total_size = 0
+    for root, dirs, names in os.walk(CACHE_DIR):
+        if root == CACHE_DIR:
+            dirs[:] = [d for d in dirs if d not in {str(z) for z in PREBAKE_ZOOMS}]
+        for name in names:
+            path = os.path.join(root, name)
+            try:
+                info = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((info.st_atime, info.st_size, path))
+            total_size += info.st_size
+
+    if total_size <= CACHE_MAX_BYTES:
+        return
+
+    files.sort()
+    for _, size, path in files:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            continue
+        total_size -= size
+        if total_size <= CACHE_MAX_BYTES:
+            break
+
+
+def start_cache_evictor():
+    """Periodically trim the tile cache in a background thread."""
+    def run():
+        while True:
+            try:
+                evict_tile_cache()
+            except Exception as e:
+                print(f"Error evicting tile cache: {e}")
+            time.sleep(CACHE_EVICT_INTERVAL)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+@functools.lru_cache(maxsize=TILE_MEMORY_CACHE_SIZE)
+def _render_tile(z: int, x: int, y: int, generation: int) -> bytes:
+    """Return gzipped MVT bytes for z/x/y from the disk cache, generating them on a miss."""
+    cache_path = tile_cache_path(z, x, y)
+    if os.path.exists(cache_path):
+        with open(cache_path, 'rb') as f:
+            return f.read()
+
+    min_lon, min_lat, max_lon, max_lat = tile_to_bbox(z, x, y)
+    with get_connection() as con:
+        query_start = time.perf_counter()
+
+        query = f"""
+            SELECT ST_AsMVT(tile, 'buildings') as mvt
+            FROM (
+                SELECT
+                    ST_AsMVTGeom(
+                        {lod_column(z)},
+                        ST_Extent(ST_TileEnvelope(?, ?, ?))
+                    ) as geometry,
+                    {', '.join(tile_properties(z))}
+                FROM buildings
+                WHERE bbox.xmin <= ?
+                  AND bbox.xmax >= ?
+                  AND bbox.ymin <= ?
+                  AND bbox.ymax >= ?
+            ) as tile
+            WHERE geometry IS NOT NULL
+        """
+        result = con.execute(
+            query, [z, x, y, max_lon, min_lon, max_lat, min_lat]
+        ).fetchone()
+        query_time = time.perf_counter() - query_start
+
+    tile_data = gzip.compress(bytes(result[0]), GZIP_LEVEL) if result and result[0] else b''
+
+    print(f"[TIMING] Tile {z}/{x}/{y}: "
+          f"query={query_time:.2f}s, "
+          f"size={len(tile_data)}bytes")
+
+    if generation == _cache_generation:
+        write_cached_tile(cache_path, tile_data)
+    return tile_data
+
+
+def query_stats(bounds) -> dict:
+    """Count buildings and sum their area within the view bounds."""
+    query = """
+        SELECT
+            COUNT(*) as count,
+            COALESCE(SUM(mercator_area), 0) as area
+        FROM buildings
+        WHERE bbox.xmin <= ?
+          AND bbox.xmax >= ?
+          AND bbox.ymin <= ?
+          AND bbox.ymax >= ?
+    """
+    params = [bounds.get('east'), bounds.get('west'), bounds.get('north'), bounds.get('south')]
+    with get_connection() as con:
+        result = con.execute(query, params).fetchone()
+    if result is None:
+        return {'count': 0, 'area': 0}
+    return {'count': result[0] or 0, 'area': result[1] or 0}
+
+
+@app.before_serving
+async def startup():
+    """Open the DuckDB pool and start cache eviction before accepting requests."""
+    print(f"Using DuckDB: {DB_FILE}")
+    print(f"Tile cache: {CACHE_DIR}")
+    await asyncio.to_thread(init_pool)
+    start_cache_evictor()
+
+
 @app.route('/tiles/<int:z>/<int:x>/<int:y>.pbf')
-def get_tile(z: int, x: int, y: int):
+async def get_tile(z: int, x: int, y: int):
     """Serve a vector tile for the given z/x/y coordinates."""
-    import time
-
-    total_start = time.perf_counter()
+    from quart import request
 
-    if z < 10:
-        return Response(b'', mimetype='application/x-protobuf')
+    # Below the source minzoom there is never anything to draw, let clients cache that for good
+    if z < MIN_ZOOM:
+        response = Response(status=204)
+        response.set_etag('empty')
+        response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+        return response
 
+    # No buildings outside the Netherlands, so don't bother querying DuckDB
     min_lon, min_lat, max_lon, max_lat = tile_to_bbox(z, x, y)
-    con = get_connection()
+    if (max_lon < NL_BBOX['min_lon'] or min_lon > NL_BBOX['max_lon']
+            or max_lat < NL_BBOX['min_lat'] or min_lat > NL_BBOX['max_lat']):
+        return Response(status=204)
+
+    # Tiles only change when the database is rebuilt, so its mtime versions them
+    etag = f"{z}-{x}-{y}-{int(os.path.getmtime(DB_FILE))}"
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.vary.add('Accept-Encoding')
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'public, max-age=86400'
+        return response
 
     try:
-        with con.cursor() as cursor:
-            query_start = time.perf_counter()
-
-            query = f"""
-                SELECT ST_AsMVT(tile, 'buildings') as mvt
-                FROM (
-                    SELECT
-                        ST_AsMVTGeom(
-                            ST_Transform(geometry, 'EPSG:4326', 'EPSG:3857', TRUE),
-                            ST_Extent(ST_TileEnvelope({z}, {x}, {y}))
-                        ) as geometry,
-                        id,
-                        name,
-                        height,
-                        class
-                    FROM buildings
-                    WHERE bbox.xmin <= {max_lon}
-                      AND bbox.xmax >= {min_lon}
-                      AND bbox.ymin <= {max_lat}
-                      AND bbox.ymax >= {min_lat}
-                ) as tile
-                WHERE geometry IS NOT NULL
-            """
-            result = cursor.execute(query).fetchone()
-            query_time = time.perf_counter() - query_start
-
-            tile_data = result[0] if result and result[0] else b''
-            total_time = time.perf_counter() - total_start
-
-            print(f"[TIMING] Tile {z}/{x}/{y}: "
-                  f"total={total_time:.2f}s, "
-                  f"query={query_time:.2f}s, "
-                  f"size={len(tile_data)}bytes")
-
-            response = Response(tile_data, mimetype='application/vnd.mapbox-vector-tile')
-            response.headers['Cache-Control'] = 'public, max-age=3600'
-            return response
-
+        # DuckDB and disk I/O block, so keep them off the event loop
+        tile_data = await asyncio.to_thread(_render_tile, z, x, y, _cache_generation)
     except Exception as e:
         print(f"Error generating tile {z}/{x}/{y}: {e}")
         import traceback
         traceback.print_exc()
         return Response(b'', mimetype='application/x-protobuf')
 
+    if not tile_data:
+        response = Response(status=204)
+    elif request.accept_encodings['gzip'] > 0:
+        response = Response(tile_data, mimetype=MVT_MIMETYPE)
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(gzip.decompress(tile_data), mimetype=MVT_MIMETYPE)
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = 'public, max-age=86400'
+    return response
+
+
+@app.route('/invalidate', methods=['POST'])
+async def invalidate():
+    """Pick up a rebuilt database: reopen the pool and drop every tile rendered from the old one.
+
+    Pre-baked zoom levels were written by the build itself and are kept.
+    """
+    from quart import jsonify
+    global _cache_generation
+
+    await asyncio.to_thread(reset_pool)
+    _cache_generation += 1
+
+    if os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            if name not in {str(z) for z in PREBAKE_ZOOMS}:
+                await asyncio.to_thread(shutil.rmtree, os.path.join(CACHE_DIR, name), True)
+
+    _render_tile.cache_clear()
+    return jsonify({'status': 'ok'})
+
 
 @app.route('/health')
-def health():
+async def health():
     """Health check endpoint."""
     return Response('OK', mimetype='text/plain')
 
 
 @app.route('/update-view', methods=['POST'])
-def update_view():
+async def update_view():
     """Receive view bounds from map, store for Streamlit to use."""
-    from flask import jsonify, request
+    from quart import jsonify, request
 
-    data = request.get_json()
+    data = await request.get_json()
     bounds = data.get('bounds')
     zoom = data.get('zoom')
 
     if not bounds:
         return jsonify({'status': 'error', 'message': 'No bounds provided'}), 400
 
-    # Store bounds with zoom included
+    sequence = next(_update_sequence)
+    try:
+        stats = await asyncio.to_thread(query_stats, bounds)
+    except Exception as e:
+        print(f"Error querying stats: {e}")
+        stats = {'count': 0, 'area': 0}
+
+    # Store bounds with zoom included and wake up any /bounds-stream listeners
     bounds['zoom'] = zoom
-    current_stats['bounds'] = bounds
+    async with _bounds_changed:
+        if sequence < current_stats['sequence']:
+            # A later move has already been stored while this query was running
+            return jsonify({'status': 'ok'})
+        current_stats.update(stats)
+        current_stats['bounds'] = bounds
+        current_stats['sequence'] = sequence
+        current_stats['version'] += 1
+        _bounds_changed.notify_all()
     return jsonify({'status': 'ok'})
 
 
 @app.route('/get-bounds')
-def get_bounds():
-    """Return current view bounds for Streamlit to query."""
-    from flask import jsonify
-    return jsonify({'bounds': current_stats.get('bounds')})
+async def get_bounds():
+    """Return current view bounds and building stats for Streamlit."""
+    from quart import jsonify
+    return jsonify(view_stats())
+
+
+def view_stats() -> dict:
+    """Snapshot of the current view bounds and stats, as sent to Streamlit."""
+    return {
+        'bounds': current_stats['bounds'],
+        'count': current_stats['count'],
+        'area': current_stats['area']
+    }
+
+
+@app.route('/bounds-stream')
+async def bounds_stream():
+    """Push view bounds and stats to Streamlit as Server-Sent Events whenever the map moves."""
+    import json
+
+    async def events():
+        version = -1
+        while True:
+            async with _bounds_changed:
+                try:
+                    await asyncio.wait_for(
+                        _bounds_changed.wait_for(lambda: current_stats['version'] != version),
+                        timeout=STREAM_HEARTBEAT_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    pass
+                changed = current_stats['version'] != version
+                version = current_stats['version']
+                stats = view_stats()
+
+            if changed and stats['bounds']:
+                yield f"data: {json.dumps(stats)}\n\n"
+            else:
+                # Comment line keeps the connection alive and detects closed clients
+                yield ": keepalive\n\n"
+
+    response = Response(events(), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.timeout = None
+    return response
 
 
 @app.route('/')
-def index():
+async def index():
     """Serve the map HTML."""
-    from flask import request
+    from quart import request
 
     center_lng = request.args.get('lng', '5.12')
     center_lat = request.args.get('lat', '52.09')
     zoom = request.args.get('zoom', '15')
-    min_zoom = request.args.get('minzoom', '10')
+    min_zoom = request.args.get('minzoom', str(MIN_ZOOM))
     color = request.args.get('color', '#3388ff')
     opacity = request.args.get('opacity', '0.6')
 
@@ -256,14 +555,16 @@ def index():
 
 
 def run_server(host: str = '127.0.0.1', port: int = 8080):
-    """Run the tile server using waitress."""
-    from waitress import serve
+    """Run the tile server using uvicorn."""
+    import uvicorn
     print(f"Starting tile server on http://{host}:{port}")
-    print(f"Using DuckDB: {DB_FILE}")
-    serve(app, host=host, port=port, threads=4)
+    uvicorn.run(app, host=host, port=port, log_level='warning')
 
 
 if __name__ == '__main__':
-    print(f"Starting tile server on http://127.0.0.1:8080")
-    print(f"Using DuckDB: {DB_FILE}")
-    app.run(host='0.0.0.0', port=8080, debug=False, threaded=True)
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=8080)
+    args = parser.parse_args()
+    run_server(host=args.host, port=args.port)
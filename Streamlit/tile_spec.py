@@ -0,0 +1,47 @@
+"""
+Tile contents shared by the tile server and the build-time pre-bake in build_indexed_db.py.
+
+Pre-baked tiles are served as-is, so both must render them from exactly these definitions.
+"""
+
+# Netherlands bounding box (approximate), the extent of the database
+NL_BBOX = {
+    'min_lon': 3.35,
+    'max_lon': 7.25,
+    'min_lat': 50.75,
+    'max_lat': 53.55
+}
+
+# Zoom levels pre-baked into the tile cache at build time (never evicted by the tile server)
+PREBAKE_ZOOMS = (10, 11, 12)
+
+# Gzip level of the cached .pbf.gz tiles
+GZIP_LEVEL = 6
+
+# Simplified geometry columns (level of detail) and their tolerance in web-mercator metres,
+# roughly the ground resolution of the zoom level each one is rendered at
+LOD_TOLERANCES = {
+    'geom_z10': 78.0,
+    'geom_z12': 19.0,
+    'geom_z14': 5.0
+}
+
+
+def lod_column(z: int) -> str:
+    """Pick the geometry column to render at zoom z: simplified below z15, exact footprints above."""
+    if z <= 11:
+        return 'geom_z10'
+    elif z <= 13:
+        return 'geom_z12'
+    elif z <= 14:
+        return 'geom_z14'
+    return 'geom_3857'
+
+
+def tile_properties(z: int) -> list[str]:
+    """Pick the building attributes encoded into tiles at zoom z."""
+    if z <= 12:
+        return ['id']
+    elif z <= 13:
+        return ['id', 'height', 'class']
+    return ['id', 'height', 'class', 'name']
@@ -2,12 +2,113 @@
 Build a DuckDB database with spatial index from the NL buildings parquet file.
 """
 import duckdb
+import gzip
+import math
+import shutil
+import sys
 import time
 import os
 
+# Tile definitions shared with the tile server
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "Streamlit"))
+from tile_spec import GZIP_LEVEL, LOD_TOLERANCES, NL_BBOX, PREBAKE_ZOOMS, lod_column, tile_properties
+
 PARQUET_FILE = "nl_buildings.parquet"
 DB_FILE = "nl_buildings.duckdb"
 
+# Pre-baked gzipped tiles, read by the tile server's disk cache
+TILE_CACHE_DIR = "tiles_cache"
+PREBAKE_CHUNK_SIZE = 256
+
+
+def lonlat_to_tile(z: int, lon: float, lat: float) -> tuple[int, int]:
+    """Convert a WGS84 coordinate to the tile containing it."""
+    n = 2 ** z
+    x = int((lon + 180.0) / 360.0 * n)
+    lat_rad = math.radians(lat)
+    y = int((1.0 - math.asinh(math.tan(lat_rad)) / math.pi) / 2.0 * n)
+    return (x, y)
+
+
+def nl_tile_range(z: int):
+    """Yield the (x, y) tiles at zoom z that intersect the Netherlands bounding box."""
+    min_x, min_y = lonlat_to_tile(z, NL_BBOX['min_lon'], NL_BBOX['max_lat'])
+    max_x, max_y = lonlat_to_tile(z, NL_BBOX['max_lon'], NL_BBOX['min_lat'])
+    for x in range(min_x, max_x + 1):
+        for y in range(min_y, max_y + 1):
+            yield (x, y)
+
+
+def write_tile(z: int, x: int, y: int, tile_data: bytes):
+    """Write gzipped tile bytes to the tile cache."""
+    path = os.path.join(TILE_CACHE_DIR, f"{z}/{x}/{y}.pbf.gz")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(tile_data)
+
+
+def prebake_zoom(con, z: int) -> tuple[int, int]:
+    """Generate every tile at zoom z in one query and write them gzipped to the tile cache.
+
+    Each building is assigned to the tiles its bbox spans, and ST_AsMVT aggregates
+    them per tile, so the whole zoom level is a single scan of the buildings table.
+    Returns the number of tiles written and their total size in bytes.
+    """
+    n = 2 ** z
+    properties = tile_properties(z)
+    struct_fields = ', '.join(f"'{p}': {p}" for p in properties)
+    query = f"""
+        SELECT x, y, ST_AsMVT({{
+            'geometry': geometry,
+            {struct_fields}
+        }}, 'buildings') as mvt
+        FROM (
+            SELECT
+                x,
+                y,
+                ST_AsMVTGeom(
+                    {lod_column(z)},
+                    ST_Extent(ST_TileEnvelope({z}, x::INTEGER, y::INTEGER))
+                ) as geometry,
+                {', '.join(properties)}
+            FROM (
+                SELECT *, unnest(range(min_y, max_y + 1)) as y
+                FROM (
+                    SELECT *, unnest(range(min_x, max_x + 1)) as x
+                    FROM (
+                        SELECT
+                            *,
+                            floor((bbox.xmin + 180) / 360 * {n})::BIGINT as min_x,
+                            floor((bbox.xmax + 180) / 360 * {n})::BIGINT as max_x,
+                            floor((1 - asinh(tan(radians(bbox.ymax))) / pi()) / 2 * {n})::BIGINT as min_y,
+                            floor((1 - asinh(tan(radians(bbox.ymin))) / pi()) / 2 * {n})::BIGINT as max_y
+                        FROM buildings
+                    )
+                )
+            )
+        ) as tile
+        WHERE geometry IS NOT NULL
+        GROUP BY x, y
+    """
+    result = con.execute(query)
+
+    written = set()
+    total_size = 0
+    while rows := result.fetchmany(PREBAKE_CHUNK_SIZE):
+        for x, y, mvt in rows:
+            tile_data = gzip.compress(bytes(mvt), GZIP_LEVEL) if mvt else b''
+            write_tile(z, x, y, tile_data)
+            written.add((x, y))
+            total_size += len(tile_data)
+
+    # Tiles without any building still get an empty file, so the server never queries them
+    for x, y in nl_tile_range(z):
+        if (x, y) not in written:
+            write_tile(z, x, y, b'')
+            written.add((x, y))
+
+    return len(written), total_size
+
 
 def main():
     print("=" * 60)
@@ -23,6 +124,11 @@ def main():
         print(f"Removing existing {DB_FILE}...")
         os.remove(DB_FILE)
 
+    # Cached tiles were generated from the old database
+    if os.path.exists(TILE_CACHE_DIR):
+        print(f"Removing existing {TILE_CACHE_DIR}/...")
+        shutil.rmtree(TILE_CACHE_DIR)
+
     # Connect to new database
     print(f"\nCreating {DB_FILE}...")
     con = duckdb.connect(DB_FILE)
@@ -42,7 +148,17 @@ def main():
             height,
             class,
             subtype,
-            num_floors
+            num_floors,
+            ST_Transform(geometry, 'EPSG:4326', 'EPSG:3857', TRUE) AS geom_3857,
+            ST_Area(geom_3857) AS mercator_area,
+            -- Buildings smaller than the coarsest tolerance would collapse, so leave them out
+            CASE
+                WHEN sqrt(power(ST_XMax(geom_3857) - ST_XMin(geom_3857), 2)
+                          + power(ST_YMax(geom_3857) - ST_YMin(geom_3857), 2)) >= {LOD_TOLERANCES['geom_z10']}
+                THEN ST_SimplifyPreserveTopology(geom_3857, {LOD_TOLERANCES['geom_z10']})
+            END AS geom_z10,
+            ST_SimplifyPreserveTopology(geom_3857, {LOD_TOLERANCES['geom_z12']}) AS geom_z12,
+            ST_SimplifyPreserveTopology(geom_3857, {LOD_TOLERANCES['geom_z14']}) AS geom_z14
         FROM '{PARQUET_FILE}'
     """)
 
@@ -65,6 +181,23 @@ def main():
 
     # Note: bbox index not needed since we use the spatial R-tree index
 
+    # Pre-generate low-zoom tiles, the most expensive ones to render on demand
+    print(f"\nPre-baking tiles for zoom levels {', '.join(map(str, PREBAKE_ZOOMS))}...")
+    prebake_start = time.perf_counter()
+
+    tile_count = 0
+    prebake_size = 0
+    for z in PREBAKE_ZOOMS:
+        zoom_start = time.perf_counter()
+        zoom_tiles, zoom_size = prebake_zoom(con, z)
+        tile_count += zoom_tiles
+        prebake_size += zoom_size
+        print(f"  z{z}: {zoom_tiles:,} tiles in {time.perf_counter() - zoom_start:.1f}s")
+
+    prebake_time = time.perf_counter() - prebake_start
+    prebake_mb = prebake_size / (1024 * 1024)
+    print(f"Pre-baked {tile_count:,} tiles ({prebake_mb:.1f} MB) in {prebake_time:.1f}s")
+
     # Close and check file size
     con.close()
 
@@ -77,7 +210,8 @@ def main():
     print(f"Buildings: {count:,}")
     print(f"Database size: {size_mb:.1f} MB")
     print(f"Indexes: geometry (R-tree), bbox")
-    print(f"Output: {DB_FILE}")
+    print(f"Pre-baked tiles: {tile_count:,} (z{PREBAKE_ZOOMS[0]}-z{PREBAKE_ZOOMS[-1]})")
+    print(f"Output: {DB_FILE}, {TILE_CACHE_DIR}/")
 
 
 if __name__ == "__main__":
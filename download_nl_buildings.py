@@ -43,6 +43,15 @@ def main():
     con.execute("INSTALL spatial; LOAD spatial;")
     con.execute("INSTALL httpfs; LOAD httpfs;")
     con.execute("SET s3_region='us-west-2';")
+    # Cache parquet footers so the count and download passes prune row groups without refetching them
+    con.execute("SET parquet_metadata_cache=true; SET enable_object_cache=true;")
+
+    # Closed intervals on the bbox minimums compare cleanly against each row group's min/max
+    # statistics, so row groups entirely outside the Netherlands are skipped
+    bbox_filter = f"""
+        bbox.xmin BETWEEN {NL_BBOX['min_lon']} AND {NL_BBOX['max_lon']}
+        AND bbox.ymin BETWEEN {NL_BBOX['min_lat']} AND {NL_BBOX['max_lat']}
+    """
 
     # First, count the buildings
     print("\nCounting buildings in Netherlands (this may take a few minutes)...")
@@ -51,10 +60,7 @@ def main():
     count_query = f"""
         SELECT COUNT(*) as count
         FROM read_parquet('{OVERTURE_PATH}', hive_partitioning=1)
-        WHERE bbox.xmin <= {NL_BBOX['max_lon']}
-          AND bbox.xmax >= {NL_BBOX['min_lon']}
-          AND bbox.ymin <= {NL_BBOX['max_lat']}
-          AND bbox.ymax >= {NL_BBOX['min_lat']}
+        WHERE {bbox_filter}
     """
     result = con.execute(count_query).fetchone()
     count = result[0]
@@ -82,10 +88,7 @@ def main():
                 roof_color,
                 facade_color
             FROM read_parquet('{OVERTURE_PATH}', hive_partitioning=1)
-            WHERE bbox.xmin <= {NL_BBOX['max_lon']}
-              AND bbox.xmax >= {NL_BBOX['min_lon']}
-              AND bbox.ymin <= {NL_BBOX['max_lat']}
-              AND bbox.ymax >= {NL_BBOX['min_lat']}
+            WHERE {bbox_filter}
         ) TO '{OUTPUT_FILE}' (FORMAT PARQUET, COMPRESSION ZSTD)
     """
     con.execute(download_query)